@@ -21,6 +21,7 @@
 """A module that implements core functionality for library or standalone use."""
 import asyncio
 import datetime
+import functools
 import logging
 import os
 import platform
@@ -31,6 +32,7 @@ import signal
 import subprocess
 import sys
 import tempfile
+import threading
 import time as time_mod
 
 from munet import unshare
@@ -55,6 +57,9 @@ root_hostname = subprocess.check_output("hostname")
 # This allows us to cleanup any leftovers later on
 os.environ["MUNET_PID"] = str(os.getpid())
 
+# Matches a bare `cd` command, which would have no effect when run
+_CD_RE = re.compile(r"cd(\s*|\s+(\S+))$")
+
 
 class MunetError(Exception):
     "A generic munet error"
@@ -125,6 +130,13 @@ def get_kernel_version():
     return kv
 
 
+# Suffix to (multiplier, multiplier with "i" suffix), lower case is always base 1024
+_SUFFIX_MULTIPLIERS = {
+    **{c: (1000**i, 1024**i) for i, c in enumerate("KMGTPEZY", 1)},
+    **{c: (1024**i, 1024**i) for i, c in enumerate("kmgtpezy", 1)},
+}
+
+
 def convert_number(value) -> int:
     """Convert a number value with a possible suffix to an integer.
 
@@ -139,19 +151,27 @@ def convert_number(value) -> int:
     """
     if value is None:
         raise ValueError("Invalid value None for convert_number")
-    rate = str(value)
-    base = 1000
-    if rate[-1] == "i":
-        base = 1024
-        rate = rate[:-1]
-    suffix = "KMGTPEZY"
-    index = suffix.find(rate[-1])
-    if index == -1:
-        base = 1024
-        index = suffix.lower().find(rate[-1])
-    if index != -1:
+    if type(value) is int:  # pylint: disable=C0123
+        return value
+    return _convert_number_str(str(value))
+
+
+@functools.lru_cache(maxsize=256)
+def _convert_number_str(rate):
+    # Links tend to share the same few constraint values, so these are cached.
+    binary = rate[-1] == "i"
+    if binary:
         rate = rate[:-1]
-    return int(rate) * base ** (index + 1)
+    if multipliers := _SUFFIX_MULTIPLIERS.get(rate[-1]):
+        return int(rate[:-1]) * multipliers[binary]
+    return int(rate)
+
+
+def _spawn_preexec():
+    os.setsid()
+    # Don't leave a piped (non-pty) spawned process running if we exit without
+    # cleaning it up. NOTE: this is tied to the spawning thread, not the process.
+    unshare.set_pdeathsig(signal.SIGKILL)
 
 
 def is_file_like(fo):
@@ -188,6 +208,35 @@ async def _async_get_exec_path(binary, cmdf, cache):
     return None
 
 
+# Per-thread event loops for `_run_sync`
+_sync_local = threading.local()
+
+
+def _run_sync(coro):
+    """Run `coro` to completion from synchronous code.
+
+    Unlike `asyncio.run` the calling thread's event loop is reused between calls
+    rather than being created and closed each time. Like `asyncio.run`, any tasks
+    left pending by `coro` are cancelled before returning.
+    """
+    loop = getattr(_sync_local, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _sync_local.loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        try:
+            if pending := asyncio.all_tasks(loop):
+                for task in pending:
+                    task.cancel()
+                loop.run_until_complete(
+                    asyncio.gather(*pending, return_exceptions=True)
+                )
+        finally:
+            asyncio.set_event_loop(None)
+
+
 def _get_exec_path(binary, cmdf, cache):
     if isinstance(binary, str):
         bins = [binary]
@@ -404,7 +453,9 @@ class Commander:  # pylint: disable=R0904
 
         # this is required to avoid receiving a STOPPED signal on expect!
         if not use_pty:
-            defaults["preexec_fn"] = os.setsid
+            # The preexec_fn calls into libc after the fork, so load it here first
+            unshare.load_libc()
+            defaults["preexec_fn"] = _spawn_preexec
 
         self.logger.debug(
             '%s: _spawn("%s", skip_pre_cmd %s use_pty %s kwargs: %s)',
@@ -708,7 +759,7 @@ class Commander:  # pylint: disable=R0904
             cmds = cmd
         else:
             # Make sure the code doesn't think `cd` will work.
-            assert not re.match(r"cd(\s*|\s+(\S+))$", cmd)
+            assert not _CD_RE.match(cmd)
             cmds = ["/bin/bash", "-c", cmd]
         return cmds
 
@@ -950,7 +1001,7 @@ class Commander:  # pylint: disable=R0904
 
     def delete(self):
         "Calls self.async_delete within an exec loop"
-        asyncio.run(self.async_delete())
+        _run_sync(self.async_delete())
 
     async def _async_delete(self):
         """Delete this objects resources.
@@ -1126,18 +1177,34 @@ class InterfaceMixin:
             rate (int): bits per second, string allows for use of
                 {KMGTKiMiGiTi} prefixes "i" means K == 1024 otherwise K == 1000.
         """
+        if cmd := self._get_intf_constraints_cmd(ifname, constraints):
+            self.cmd_raises(cmd)
+
+    async def async_set_intf_constraints(self, ifname, **constraints):
+        """Set interface outbound constraints.
+
+        Async version of `set_intf_constraints()`, see it for the arguments.
+        """
+        if cmd := self._get_intf_constraints_cmd(ifname, constraints):
+            await self.async_cmd_raises(cmd)
+
+    def _get_intf_constraints_cmd(self, ifname, constraints):
         netem_args, tbf_args = self.get_linux_tc_args(ifname, constraints)
         count = 1
         selector = f"root handle {count}:"
+        tc_cmds = []
         if netem_args:
-            self.cmd_raises(f"tc qdisc add dev {ifname} {selector} netem {netem_args}")
+            tc_cmds.append(f"tc qdisc add dev {ifname} {selector} netem {netem_args}")
             count += 1
             selector = f"parent {count-1}: handle {count}"
         # Place rate limit after delay otherwise limit/burst too complex
         if tbf_args:
-            self.cmd_raises(f"tc qdisc add dev {ifname} {selector} tbf {tbf_args}")
+            tc_cmds.append(f"tc qdisc add dev {ifname} {selector} tbf {tbf_args}")
 
-        self.cmd_raises(f"tc qdisc show dev {ifname}")
+        # Run the commands in a single shell, the qdisc show is only for debugging
+        if self.logger.isEnabledFor(logging.DEBUG):
+            tc_cmds.append(f"tc qdisc show dev {ifname}")
+        return " && ".join(tc_cmds)
 
 
 class LinuxNamespace(Commander, InterfaceMixin):
@@ -1326,6 +1393,8 @@ class LinuxNamespace(Commander, InterfaceMixin):
         # Now let's wait until unshare completes it's job
         # -----------------------------------------------
         timeout = Timeout(30)
+        # Unsharing normally completes quickly so start polling with a short delay
+        delay = 0.01
         while (p is None or p.poll() is None) and not timeout.is_expired():
             for fname in tuple(nslist):
                 if p is None:
@@ -1342,7 +1411,8 @@ class LinuxNamespace(Commander, InterfaceMixin):
                 break
             elapsed = int(timeout.elapsed())
             if elapsed <= 3:
-                time_mod.sleep(0.1)
+                time_mod.sleep(delay)
+                delay = min(delay * 2, 0.1)
             elif elapsed > 10:
                 self.logger.warning(
                     "%s: unshare taking more than %ss: %s", self, elapsed, nslist
@@ -1378,9 +1448,12 @@ class LinuxNamespace(Commander, InterfaceMixin):
         # We do not want cmd_status in child classes (e.g., container) for the remaining
         # setup calls in this __init__ function.
         #
-        self.cmd_status_host(f"mkdir {tmpmnt} && mount --rbind /sys/fs/cgroup {tmpmnt}")
-        self.cmd_status_host("mount -t sysfs sysfs /sys")
-        self.cmd_status_host(f"mount --move {tmpmnt} /sys/fs/cgroup && rmdir {tmpmnt}")
+        # Run as a single command to avoid entering the namespace once per step.
+        self.cmd_status_host(
+            f"mkdir {tmpmnt} && mount --rbind /sys/fs/cgroup {tmpmnt}; "
+            "mount -t sysfs sysfs /sys; "
+            f"mount --move {tmpmnt} /sys/fs/cgroup && rmdir {tmpmnt}"
+        )
         # self.cmd_raises(
         #     f"mount -N {self.pid} --bind /sys/fs/cgroup /sys/fs/cgroup",
         #     skip_pre_cmd=True,
@@ -1478,8 +1551,7 @@ class LinuxNamespace(Commander, InterfaceMixin):
         self.logger.debug("Moving interface %s to default namespace", intf)
         self.set_intf_netns(intf, str(self.pid))
 
-    def intf_ip_cmd(self, intf, cmd):
-        """Run an ip command, considering an interface's possible namespace."""
+    def _get_intf_ip_cmd(self, intf, cmd):
         if intf in self.ifnetns:
             if isinstance(cmd, list):
                 assert cmd[0].endswith("ip")
@@ -1487,7 +1559,15 @@ class LinuxNamespace(Commander, InterfaceMixin):
             else:
                 assert cmd.startswith("ip ")
                 cmd = "ip -n " + self.ifnetns[intf] + cmd[2:]
-        self.cmd_raises_host(cmd)
+        return cmd
+
+    def intf_ip_cmd(self, intf, cmd):
+        """Run an ip command, considering an interface's possible namespace."""
+        self.cmd_raises_host(self._get_intf_ip_cmd(intf, cmd))
+
+    async def async_intf_ip_cmd(self, intf, cmd):
+        """Run an ip command, considering an interface's possible namespace."""
+        await self.async_cmd_raises_host(self._get_intf_ip_cmd(intf, cmd))
 
     def intf_tc_cmd(self, intf, cmd):
         """Run a tc command, considering an interface's possible namespace."""
@@ -43,8 +43,21 @@ def find_all_with_kv(lst, k, v):
     return rv
 
 
-def find_matching_net_config(name, cconf, oconf):
-    p = find_all_with_kv(oconf.get("connections", {}), "to", name)
+def index_net_connections(oconf):
+    "Return a dict of the connections in `oconf` as lists keyed on their `to` value"
+    index = {}
+    for c in oconf.get("connections", []):
+        if isinstance(c, dict) and "to" in c:
+            index.setdefault(c["to"], []).append(c)
+    return index
+
+
+def find_matching_net_config(name, cconf, oconf, index=None):
+    if index is None:
+        p = find_all_with_kv(oconf.get("connections", {}), "to", name)
+    else:
+        # `index` is the result of `index_net_connections(oconf)`
+        p = index.get(name)
     if not p:
         return {}
 
@@ -117,22 +130,21 @@ def value_merge_deepcopy(s1, s2):
 
 
 def merge_kind_config(kconf, config):
+    """Return a new config with `config` merged over the kind config `kconf`.
+
+    Neither argument is modified. Unmerged values are shared with the arguments
+    rather than copied, so callers must copy the result before modifying it in
+    place (`config_subst` returns new containers).
+    """
     mergekeys = kconf.get("merge", [])
-    config = deepcopy(config)
-    new = deepcopy(kconf)
-    for k in new:
-        if k not in config:
-            continue
-
-        if k not in mergekeys:
-            new[k] = config[k]
+    new = dict(kconf)
+    for k, v in config.items():
+        if k not in new or k not in mergekeys:
+            new[k] = v
         elif isinstance(new[k], list):
-            new[k].extend(config[k])
+            new[k] = [*new[k], *v]
         elif isinstance(new[k], dict):
-            new[k] = {**new[k], **config[k]}
+            new[k] = {**new[k], **v}
         else:
-            new[k] = config[k]
-    for k in config:
-        if k not in new:
-            new[k] = config[k]
+            new[k] = v
     return new
@@ -21,14 +21,19 @@
 "A module that defines objects for standalone use."
 import asyncio
 import errno
+import fcntl
+import functools
 import ipaddress
 import logging
 import os
-import random
 import re
 import shlex
+import shutil
 import socket
 import subprocess
+import time as time_mod
+
+from types import MappingProxyType
 
 from . import cli
 from .base import BaseMunet
@@ -37,6 +42,7 @@ from .base import Commander
 from .base import LinuxNamespace
 from .base import MunetError
 from .base import Timeout
+from .base import _CD_RE
 from .base import _async_get_exec_path
 from .base import _get_exec_path
 from .base import cmd_error
@@ -46,6 +52,7 @@ from .config import config_subst
 from .config import config_to_dict_with_key
 from .config import find_matching_net_config
 from .config import find_with_kv
+from .config import index_net_connections
 from .config import merge_kind_config
 
 
@@ -53,10 +60,56 @@ class L3ContainerNotRunningError(MunetError):
     "Exception if no running container exists"
 
 
+# The static part of a node's hosts file, it follows the node's localhost entry
+_HOSTS_HEADER = b"""::1\tip6-localhost ip6-loopback
+fe00::0\tip6-localnet
+ff00::0\tip6-mcastprefix
+ff02::1\tip6-allnodes
+ff02::2\tip6-allrouters
+"""
+
+
+def write_exec_file(pathname, content):
+    "Write `content` to the executable (mode 755) file `pathname`"
+    fd = os.open(pathname, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o755)
+    with open(fd, "w", encoding="utf-8") as f:
+        # The create mode is subject to the umask, so set it explicitly
+        os.fchmod(fd, 0o755)
+        f.write(content)
+
+
+# Reflink ioctl from linux/fs.h
+_FICLONE = 0x40049409
+
+
+def copy_file(source, dest, mode):
+    "Copy `source` to `dest` created with `mode`, sharing blocks where supported"
+    with open(source, "rb") as fsrc:
+        fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+        with open(fd, "wb") as fdst:
+            os.fchmod(fd, mode)
+            try:
+                fcntl.ioctl(fd, _FICLONE, fsrc.fileno())
+            except OSError:
+                shutil.copyfileobj(fsrc, fdst)
+
+
+# Base addresses for auto-numbering, kept as parsed objects or integers so that
+# allocating an address is integer arithmetic rather than parsing.
+_AUTO_BRIDGE_NETWORK = ipaddress.ip_network("10.0.0.0/24")
+_AUTO_LOOPBACK_ADDR = int(ipaddress.ip_address("10.255.0.0"))
+
+# Max number of links configured concurrently while building the topology
+_MAX_LINK_CONFIGS = 16
+
+# Seconds to wait for a container's start event before polling `podman ps`
+_START_EVENT_WAIT = 5
+
+
 def get_loopback_ips(c, nid):
     if ip := c.get("ip"):
         if ip == "auto":
-            return [ipaddress.ip_interface("10.255.0.0/32") + nid]
+            return [ipaddress.IPv4Interface(_AUTO_LOOPBACK_ADDR + nid)]
         if isinstance(ip, str):
             return [ipaddress.ip_interface(ip)]
         return [ipaddress.ip_interface(x) for x in ip]
@@ -64,10 +117,13 @@ def get_loopback_ips(c, nid):
 
 
 def make_ip_network(net, inc):
-    n = ipaddress.ip_network(net)
-    return ipaddress.ip_network(
-        (n.network_address + inc * n.num_addresses, n.prefixlen)
-    )
+    if isinstance(net, (ipaddress.IPv4Network, ipaddress.IPv6Network)):
+        n = net
+    else:
+        n = ipaddress.ip_network(net)
+    # i.e., network address + inc * num_addresses
+    addr = int(n.network_address) + (inc << (n.max_prefixlen - n.prefixlen))
+    return type(n)((addr, n.prefixlen))
 
 
 def get_ip_network(c, brid):
@@ -80,7 +136,7 @@ def get_ip_network(c, brid):
             return ifip
         except ValueError:
             return ipaddress.ip_network(ip)
-    return make_ip_network("10.0.0.0/24", brid)
+    return make_ip_network(_AUTO_BRIDGE_NETWORK, brid)
 
 
 def parse_pciaddr(devaddr):
@@ -104,6 +160,15 @@ def read_sym_basename(path):
     return os.path.basename(os.readlink(path))
 
 
+def get_shell_cmd(config):
+    """Return the shell to run a node's `cmd` with, or "" for no shell."""
+    # shell is a union and can be boolean or string
+    shell_cmd = config.get("shell", "/bin/bash")
+    if not isinstance(shell_cmd, str):
+        shell_cmd = "/bin/bash" if shell_cmd else ""
+    return shell_cmd
+
+
 async def to_thread(func):
     """to_thread for python < 3.9"""
     try:
@@ -113,6 +178,27 @@ async def to_thread(func):
         return await asyncio.get_running_loop().run_in_executor(None, func)
 
 
+@functools.lru_cache(maxsize=256)
+def split_cmd(cmd):
+    """Return a tuple of `cmd` split as a shell would, cached for similar nodes."""
+    return tuple(shlex.split(cmd))
+
+
+def get_podman_config_args(config):
+    "Return the podman run args for a container node's `config`"
+    envdict = config.get("env", {})
+    if envdict is None:
+        envdict = {}
+    args = [f"--env={k}={v}" for k, v in envdict.items()]
+    args += [f"--cap-add={x}" for x in config.get("cap-add", [])]
+    args += [f"--cap-drop={x}" for x in config.get("cap-drop", [])]
+    # args += [f"--expose={x.split(':')[0]}" for x in config.get("ports", [])]
+    args += [f"--publish={x}" for x in config.get("ports", [])]
+    if "podman" in config:
+        args += [x.strip() for x in config["podman"].get("extra-args", [])]
+    return args
+
+
 class L2Bridge(Bridge):
     """
     A linux bridge with no IP network address.
@@ -190,6 +276,7 @@ class L3Node(LinuxNamespace):
 
         self.config = config if config else {}
         config = self.config
+        self.shell_cmd = get_shell_cmd(config)
 
         self.cmd_p = None
         self.container_id = None
@@ -206,6 +293,14 @@ class L3Node(LinuxNamespace):
 
         self.intf_tc_count = 0
 
+        # Output files of the node's "cmd:", see `get_cmd_output_files()`
+        self.cmd_stdout = None
+        self.cmd_stderr = None
+
+        # Map of network name to interface name, see `get_ifname()`
+        self.ifname_by_net = None
+        self.ifname_by_net_conns = None
+
         if not name:
             name = "r{}".format(self.id)
 
@@ -226,16 +321,18 @@ class L3Node(LinuxNamespace):
             self.cmd_raises("sysctl -w net.ipv6.conf.all.autoconf=0")
             self.cmd_raises("sysctl -w net.ipv6.conf.all.disable_ipv6=1")
 
-        self.next_p2p_network = ipaddress.ip_network(f"10.254.{self.id}.0/31")
+        # Next auto-numbered p2p /31 network address (as an integer)
+        self.next_p2p_addr = int(ipaddress.ip_address(f"10.254.{self.id}.0"))
 
         self.loopback_ip = None
         self.loopback_ips = get_loopback_ips(self.config, self.id)
         self.loopback_ip = self.loopback_ips[0] if self.loopback_ips else None
         if self.loopback_ip:
-            self.cmd_raises_host(f"ip addr add {self.loopback_ip} dev lo")
-            self.cmd_raises_host("ip link set lo up")
-            for i, ip in enumerate(self.loopback_ips[1:]):
-                self.cmd_raises_host(f"ip addr add {ip} dev lo:{i}")
+            lo_strs = [str(x) for x in self.loopback_ips]
+            # Configure all the loopback addresses with a single ip invocation
+            batch = [f"addr add {lo_strs[0]} dev lo", "link set lo up"]
+            batch += [f"addr add {ip} dev lo:{i}" for i, ip in enumerate(lo_strs[1:])]
+            self.cmd_raises_host("ip -batch -", stdin="\n".join(batch) + "\n")
 
         # -------------------
         # Setup node's rundir
@@ -251,16 +348,9 @@ class L3Node(LinuxNamespace):
         # Create a hosts file to map our name
         hosts_file = os.path.join(self.rundir, "hosts.txt")
         if not os.path.exists(hosts_file):
-            with open(hosts_file, "w+", encoding="ascii") as hf:
-                hf.write(
-                    f"""127.0.0.1\tlocalhost {self.name}
-::1\tip6-localhost ip6-loopback
-fe00::0\tip6-localnet
-ff00::0\tip6-mcastprefix
-ff02::1\tip6-allnodes
-ff02::2\tip6-allrouters
-"""
-                )
+            with open(hosts_file, "wb") as hf:
+                localhost = f"127.0.0.1\tlocalhost {self.name}\n".encode("ascii")
+                hf.write(localhost + _HOSTS_HEADER)
         self.bind_mount(hosts_file, "/etc/hosts")
 
         if not self.is_container:
@@ -369,34 +459,43 @@ ff02::2\tip6-allrouters
                 continue
             raise NotImplementedError("complex mounts for non-containers")
 
+    def get_cmd_output_files(self):
+        "Return the stdout and stderr files for the node's cmd, opening on first use"
+        if self.cmd_stdout is None:
+            self.cmd_stdout = open(os.path.join(self.rundir, "cmd.out"), "wb")
+            self.cmd_stderr = open(os.path.join(self.rundir, "cmd.err"), "wb")
+        return self.cmd_stdout, self.cmd_stderr
+
     def get_ifname(self, netname):
-        for c in self.config["connections"]:
-            if c["to"] == netname:
-                return c["name"]
-        return None
+        # The connections are replaced (normalized) when building the topology so
+        # (re)build the map if the list has changed.
+        conns = self.config["connections"]
+        if self.ifname_by_net_conns is not conns:
+            ifname_by_net = {}
+            for c in conns:
+                if "to" in c and "name" in c:
+                    ifname_by_net.setdefault(c["to"], c["name"])
+            self.ifname_by_net = ifname_by_net
+            self.ifname_by_net_conns = conns
+        return self.ifname_by_net.get(netname)
 
     async def run_cmd(self):
         """Run the configured commands for this node"""
 
-        self.logger.debug(
-            "[rundir %s exists %s]", self.rundir, os.path.exists(self.rundir)
-        )
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "[rundir %s exists %s]", self.rundir, os.path.exists(self.rundir)
+            )
 
-        shell_cmd = self.config.get("shell", "/bin/bash")
-        if not isinstance(shell_cmd, str):
-            if shell_cmd:
-                shell_cmd = "/bin/bash"
-            else:
-                shell_cmd = ""
+        shell_cmd = self.shell_cmd
 
         cmd = self.config.get("cmd", "").strip()
         if not cmd:
             return None
 
         # See if we have a custom update for this `kind`
-        if kind := self.config.get("kind", None):
-            if kind in kind_run_cmd_update:
-                await kind_run_cmd_update[kind](self, shell_cmd, [], cmd)
+        if update := kind_run_cmd_update.get(self.config.get("kind")):
+            await update(self, shell_cmd, [], cmd)
 
         if shell_cmd:
             cmd = cmd.rstrip()
@@ -405,20 +504,15 @@ ff02::2\tip6-allrouters
             cmd = cmd.replace("%NAME%", self.name)
             cmd += "\n"
             cmdpath = os.path.join(self.rundir, "cmd.shebang")
-            with open(cmdpath, mode="w+", encoding="utf-8") as cmdfile:
-                cmdfile.write(f"#!{shell_cmd}\n")
-                cmdfile.write(cmd)
-                cmdfile.flush()
-            self.cmd_raises_host(f"chmod 755 {cmdpath}")
+            write_exec_file(cmdpath, f"#!{shell_cmd}\n" + cmd)
             cmds = [cmdpath]
         else:
-            cmds = shlex.split(cmd)
+            cmds = split_cmd(cmd)
             cmds = [x.replace("%CONFIGDIR%", self.unet.config_dirname) for x in cmds]
             cmds = [x.replace("%RUNDIR%", self.rundir) for x in cmds]
             cmds = [x.replace("%NAME%", self.name) for x in cmds]
 
-        stdout = open(os.path.join(self.rundir, "cmd.out"), "wb")
-        stderr = open(os.path.join(self.rundir, "cmd.err"), "wb")
+        stdout, stderr = self.get_cmd_output_files()
         self.cmd_p = await self.async_popen(
             cmds,
             stdin=subprocess.DEVNULL,
@@ -450,13 +544,7 @@ ff02::2\tip6-allrouters
         if not cmd:
             return
 
-        # shell_cmd is a union and can be boolean or string
-        shell_cmd = self.config.get("shell", "/bin/bash")
-        if not isinstance(shell_cmd, str):
-            if shell_cmd:
-                shell_cmd = "/bin/bash"
-            else:
-                shell_cmd = ""
+        shell_cmd = self.shell_cmd
 
         # If we have a shell_cmd then we create a cleanup_cmds file in run_cmd
         # and volume mounted it
@@ -469,11 +557,7 @@ ff02::2\tip6-allrouters
 
             # Write out our cleanup cmd file at this time too.
             cmdpath = os.path.join(self.rundir, "cleanup_cmd.shebang")
-            with open(cmdpath, mode="w+", encoding="utf-8") as cmdfile:
-                cmdfile.write(f"#!{shell_cmd}\n")
-                cmdfile.write(cmd)
-                cmdfile.flush()
-            self.cmd_raises_host(f"chmod 755 {cmdpath}")
+            write_exec_file(cmdpath, f"#!{shell_cmd}\n" + cmd)
 
             if self.container_id:
                 cmds = ["/tmp/cleanup_cmds.shebang"]
@@ -482,7 +566,7 @@ ff02::2\tip6-allrouters
         else:
             cmds = []
             if isinstance(cmd, str):
-                cmds.extend(shlex.split(cmd))
+                cmds.extend(split_cmd(cmd))
             else:
                 cmds.extend(cmd)
             cmds = [x.replace("%CONFIGDIR%", self.unet.config_dirname) for x in cmds]
@@ -509,6 +593,19 @@ ff02::2\tip6-allrouters
             self.logger.debug("%s: node cmd wait() canceled", future)
 
     def set_lan_addr(self, switch, cconf):
+        for node, ifname, cmd in self.get_lan_addr_cmds(switch, cconf):
+            if ifname:
+                node.intf_ip_cmd(ifname, cmd)
+            else:
+                node.cmd_raises(cmd)
+
+    def get_lan_addr_cmds(self, switch, cconf):
+        """Assign our address on the `switch` LAN.
+
+        Returns a list of (node, ifname, cmd) commands to run, in order, to configure
+        the address. `cmd` is an ip command for interface `ifname`, or a plain node
+        command if `ifname` is None.
+        """
         if ip := cconf.get("ip"):
             ipaddr = ipaddress.ip_interface(ip)
         elif self.unet.autonumber and "ip" not in cconf:
@@ -521,15 +618,21 @@ ff02::2\tip6-allrouters
             n = switch.ip_network
             ipaddr = ipaddress.ip_interface((n.network_address + self.id, n.prefixlen))
         else:
-            return
+            return []
 
         ifname = cconf["name"]
         self.intf_addrs[ifname] = ipaddr
-        self.logger.debug("%s: adding %s to lan intf %s", self, ipaddr, ifname)
+        # format the address once for both the log and the command
+        ipstr = str(ipaddr)
+        self.logger.debug("%s: adding %s to lan intf %s", self, ipstr, ifname)
+        cmds = []
         if not self.is_vm:
-            self.intf_ip_cmd(ifname, f"ip addr add {ipaddr} dev {ifname}")
+            cmds.append((self, ifname, f"ip addr add {ipstr} dev {ifname}"))
             if hasattr(switch, "is_nat") and switch.is_nat:
-                self.cmd_raises(f"ip route add default via {switch.ip_address}")
+                cmds.append(
+                    (self, None, f"ip route add default via {switch.ip_address}")
+                )
+        return cmds
 
     def pytest_hook_run_cmd(self, stdout, stderr):
         """
@@ -567,6 +670,15 @@ ff02::2\tip6-allrouters
             self.run_in_window("bash")
 
     def set_p2p_addr(self, other, cconf, occonf):
+        for node, ifname, cmd in self.get_p2p_addr_cmds(other, cconf, occonf):
+            node.intf_ip_cmd(ifname, cmd)
+
+    def get_p2p_addr_cmds(self, other, cconf, occonf):
+        """Assign the addresses of our p2p link with `other`.
+
+        Returns a list of (node, ifname, cmd) ip commands to run to configure the
+        addresses.
+        """
         ipaddr = ipaddress.ip_interface(cconf["ip"]) if cconf.get("ip") else None
         oipaddr = ipaddress.ip_interface(occonf["ip"]) if occonf.get("ip") else None
         self.logger.debug(
@@ -575,29 +687,33 @@ ff02::2\tip6-allrouters
 
         if not ipaddr and not oipaddr:
             if self.unet.autonumber:
-                n = self.next_p2p_network
-                self.next_p2p_network = make_ip_network(n, 1)
+                addr = self.next_p2p_addr
+                self.next_p2p_addr += 2
 
-                ipaddr = ipaddress.ip_interface(n)
-                oipaddr = ipaddress.ip_interface((ipaddr.ip + 1, n.prefixlen))
+                ipaddr = ipaddress.IPv4Interface((addr, 31))
+                oipaddr = ipaddress.IPv4Interface((addr + 1, 31))
             else:
-                return
+                return []
 
+        cmds = []
         if ipaddr:
             ifname = cconf["name"]
             self.intf_addrs[ifname] = ipaddr
-            self.logger.debug("%s: adding %s to p2p intf %s", self, ipaddr, ifname)
+            ipstr = str(ipaddr)
+            self.logger.debug("%s: adding %s to p2p intf %s", self, ipstr, ifname)
             if "physical" not in cconf and not self.is_vm:
-                self.intf_ip_cmd(ifname, f"ip addr add {ipaddr} dev {ifname}")
+                cmds.append((self, ifname, f"ip addr add {ipstr} dev {ifname}"))
 
         if oipaddr:
             oifname = occonf["name"]
             other.intf_addrs[oifname] = oipaddr
+            oipstr = str(oipaddr)
             self.logger.debug(
-                "%s: adding %s to other p2p intf %s", other, oipaddr, oifname
+                "%s: adding %s to other p2p intf %s", other, oipstr, oifname
             )
             if "physical" not in occonf and not other.is_vm:
-                other.intf_ip_cmd(oifname, f"ip addr add {oipaddr} dev {oifname}")
+                cmds.append((other, oifname, f"ip addr add {oipstr} dev {oifname}"))
+        return cmds
 
     async def add_host_intf(self, hname, lname, mtu=None):
         if hname in self.host_intfs:
@@ -770,6 +886,11 @@ ff02::2\tip6-allrouters
         for devaddr in list(self.phy_intfs):
             await self.rem_phy_intf(devaddr)
 
+        if self.cmd_stdout is not None:
+            self.cmd_stdout.close()
+            self.cmd_stderr.close()
+            self.cmd_stdout = self.cmd_stderr = None
+
         # delete the LinuxNamespace/InterfaceMixin
         await super()._async_delete()
 
@@ -784,6 +905,7 @@ class L3ContainerNode(L3Node):
         self.cont_exec_paths = {}
         self.container_id = None
         self.container_image = config["image"]
+        self.podman_exec_prefixes = {}
         self.extra_mounts = []
         assert self.container_image
 
@@ -829,22 +951,30 @@ class L3ContainerNode(L3Node):
             raise L3ContainerNotRunningError(f"{self}: cannot execute command: {cmd}")
         assert self.container_id
 
-        cmds = []
-        if sudo:
-            cmds.append(get_exec_path_host("sudo"))
-        cmds.append(get_exec_path_host("podman"))
-        cmds.append("exec")
-        cmds.append(f"-eMUNET_RUNDIR={self.unet.rundir}")
-        cmds.append(f"-eMUNET_NODENAME={self.name}")
-        if tty:
-            cmds.append("-it")
-        cmds.append(self.container_id)
-
+        # The exec prefix is the same for every command so build it only once.
+        key = (self.container_id, sudo, tty)
+        if (prefix := self.podman_exec_prefixes.get(key)) is None:
+            prefix = []
+            # sudo is only requested for commands run in a window, these are started
+            # by the user's tmux/screen/xterm and not by us, so it's needed even when
+            # we are root.
+            if sudo:
+                prefix.append(get_exec_path_host("sudo"))
+            prefix.append(get_exec_path_host("podman"))
+            prefix.append("exec")
+            prefix.append(f"-eMUNET_RUNDIR={self.unet.rundir}")
+            prefix.append(f"-eMUNET_NODENAME={self.name}")
+            if tty:
+                prefix.append("-it")
+            prefix.append(self.container_id)
+            prefix = self.podman_exec_prefixes[key] = tuple(prefix)
+
+        cmds = list(prefix)
         if not isinstance(cmd, str):
             cmds += cmd
         else:
             # Make sure the code doesn't think `cd` will work.
-            assert not re.match(r"cd(\s*|\s+(\S+))$", cmd)
+            assert not _CD_RE.match(cmd)
             cmds += ["/bin/bash", "-c", cmd]
         return cmds
 
@@ -962,18 +1092,14 @@ class L3ContainerNode(L3Node):
 
     def mount_volumes(self):
         args = []
+        config_dirname = self.unet.config_dirname
         for m in self.config.get("volumes", []):
             if isinstance(m, str):
                 s = m.split(":", 1)
                 if len(s) == 1:
                     args.append("--mount=type=tmpfs,destination=" + m)
                 else:
-                    spath = s[0]
-                    spath = os.path.abspath(
-                        os.path.join(
-                            os.path.dirname(self.unet.config["config_pathname"]), spath
-                        )
-                    )
+                    spath = os.path.abspath(os.path.join(config_dirname, s[0]))
                     if not self.test_host("-e", spath):
                         self.cmd_raises(f"mkdir -p {spath}")
                     args.append(f"--mount=type=bind,src={spath},dst={s[1]}")
@@ -986,11 +1112,7 @@ class L3ContainerNode(L3Node):
                     continue
                 if v:
                     if k in ("src", "source"):
-                        v = os.path.abspath(
-                            os.path.join(
-                                os.path.dirname(self.unet.config["config_pathname"]), v
-                            )
-                        )
+                        v = os.path.abspath(os.path.join(config_dirname, v))
                         if not self.test_host("-e", v):
                             self.cmd_raises(f"mkdir -p {v}")
                     margs.append(f"{k}={v}")
@@ -1005,9 +1127,10 @@ class L3ContainerNode(L3Node):
     async def run_cmd(self):
         """Run the configured commands for this node"""
         self.logger.debug("%s: starting container", self.name)
-        self.logger.debug(
-            "[rundir %s exists %s]", self.rundir, os.path.exists(self.rundir)
-        )
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "[rundir %s exists %s]", self.rundir, os.path.exists(self.rundir)
+            )
 
         self.container_id = f"{self.name}-{os.getpid()}"
         cmds = [
@@ -1042,39 +1165,18 @@ class L3ContainerNode(L3Node):
         if self.extra_mounts:
             cmds += self.extra_mounts
 
-        # Add environment variables:
-        envdict = self.config.get("env", {})
-        if envdict is None:
-            envdict = {}
-        for k, v in envdict.items():
-            cmds.append(f"--env={k}={v}")
-
-        # Update capabilities
-        cmds += [f"--cap-add={x}" for x in self.config.get("cap-add", [])]
-        cmds += [f"--cap-drop={x}" for x in self.config.get("cap-drop", [])]
-        # cmds += [f"--expose={x.split(':')[0]}" for x in self.config.get("ports", [])]
-        cmds += [f"--publish={x}" for x in self.config.get("ports", [])]
-
-        # Add extra flags from user:
-        if "podman" in self.config:
-            for x in self.config["podman"].get("extra-args", []):
-                cmds.append(x.strip())
-
-        # shell_cmd is a union and can be boolean or string
-        shell_cmd = self.config.get("shell", "/bin/bash")
-        if not isinstance(shell_cmd, str):
-            if shell_cmd:
-                shell_cmd = "/bin/bash"
-            else:
-                shell_cmd = ""
+        # Add environment variables, capabilities and extra flags from user:
+        cmds += get_podman_config_args(self.config)
+
+        shell_cmd = self.shell_cmd
 
         # Create cleanup cmd file
         cleanup_cmd = self.config.get("cleanup_cmd", "").strip()
         if shell_cmd and cleanup_cmd:
             # Will write the file contents out when the command is run
             cleanup_cmdpath = os.path.join(self.rundir, "cleanup_cmd.shebang")
-            await self.async_cmd_raises_host(f"touch {cleanup_cmdpath}")
-            await self.async_cmd_raises_host(f"chmod 755 {cleanup_cmdpath}")
+            os.close(os.open(cleanup_cmdpath, os.O_WRONLY | os.O_CREAT, 0o755))
+            os.chmod(cleanup_cmdpath, 0o755)
             cmds += [
                 # How can we override this?
                 # u'--entrypoint=""',
@@ -1084,9 +1186,8 @@ class L3ContainerNode(L3Node):
         cmd = self.config.get("cmd", "").strip()
 
         # See if we have a custom update for this `kind`
-        if kind := self.config.get("kind", None):
-            if kind in kind_run_cmd_update:
-                cmds, cmd = await kind_run_cmd_update[kind](self, shell_cmd, cmds, cmd)
+        if update := kind_run_cmd_update.get(self.config.get("kind")):
+            cmds, cmd = await update(self, shell_cmd, cmds, cmd)
 
         # Create running command file
         if shell_cmd and cmd:
@@ -1098,11 +1199,7 @@ class L3ContainerNode(L3Node):
             cmd = cmd.replace("%NAME%", self.name)
             cmd += "\n"
             cmdpath = os.path.join(self.rundir, "cmd.shebang")
-            with open(cmdpath, mode="w+", encoding="utf-8") as cmdfile:
-                cmdfile.write(f"#!{shell_cmd}\n")
-                cmdfile.write(cmd)
-                cmdfile.flush()
-            self.cmd_raises_host(f"chmod 755 {cmdpath}")
+            write_exec_file(cmdpath, f"#!{shell_cmd}\n" + cmd)
             cmds += [
                 # How can we override this?
                 # u'--entrypoint=""',
@@ -1115,7 +1212,7 @@ class L3ContainerNode(L3Node):
             cmds.append(self.container_image)
             if cmd:
                 if isinstance(cmd, str):
-                    cmds.extend(shlex.split(cmd))
+                    cmds.extend(split_cmd(cmd))
                 else:
                     cmds.extend(cmd)
 
@@ -1123,60 +1220,141 @@ class L3ContainerNode(L3Node):
             cmds = [x.replace("%RUNDIR%", self.rundir) for x in cmds]
             cmds = [x.replace("%NAME%", self.name) for x in cmds]
 
-        stdout = open(os.path.join(self.rundir, "cmd.out"), "wb")
-        stderr = open(os.path.join(self.rundir, "cmd.err"), "wb")
-        self.cmd_p = await self.async_popen(
-            cmds,
-            stdin=subprocess.DEVNULL,
-            stdout=stdout,
-            stderr=stderr,
-            # We don't need this here b/c we are only ever running podman and that's all
-            # we need to kill for cleanup
-            # start_new_session=True,  # allows us to signal all children to exit
-            # Skip running with `podman exec` we are creating that ability here.
-            skip_pre_cmd=True,
-        )
+        # Limit how many containers are started at once, see `Munet.run()`
+        if sem := self.unet.podman_sem:
+            async with sem:
+                await self._async_start_container(cmds)
+        else:
+            await self._async_start_container(cmds)
+
+        self.logger.info("%s: started container", self.name)
 
-        self.logger.debug("%s: async_popen => %s", self, self.cmd_p.pid)
+        self.pytest_hook_open_shell()
 
-        self.pytest_hook_run_cmd(stdout, stderr)
+        return self.cmd_p
 
-        # ---------------------------------------
-        # Now let's wait until container shows up
-        # ---------------------------------------
+    async def _async_start_container(self, cmds):
+        "Run the container with podman `cmds` and wait for it to start"
+        # Watch for the container's start event rather than polling `podman ps`. The
+        # watcher is started first, and replays events from now, so the event can't be
+        # missed.
         timeout = Timeout(30)
-        while self.cmd_p.returncode is None and not timeout.is_expired():
-            o = await self.async_cmd_raises_host(
-                f"podman ps -q -f name={self.container_id}"
-            )
-            if o.strip():
-                break
-            elapsed = int(timeout.elapsed())
-            if elapsed <= 3:
-                await asyncio.sleep(0.1)
-            else:
-                self.logger.info("%s: run_cmd taking more than %ss", self, elapsed)
-                await asyncio.sleep(1)
-        if self.cmd_p.returncode is not None:
-            self.logger.warning(
-                "%s: run_cmd exited quickly (%ss) rc: %s",
-                self,
-                timeout.elapsed(),
-                self.cmd_p.returncode,
-            )
-        elif timeout.is_expired():
-            self.logger.critical(
-                "%s: timeout (%ss) waiting for container to start",
-                self.name,
-                timeout.elapsed(),
+        events_p = await self._async_podman_start_events()
+
+        try:
+            stdout, stderr = self.get_cmd_output_files()
+            self.cmd_p = await self.async_popen(
+                cmds,
+                stdin=subprocess.DEVNULL,
+                stdout=stdout,
+                stderr=stderr,
+                # We don't need this here b/c we are only ever running podman and
+                # that's all we need to kill for cleanup
+                # start_new_session=True,  # allows us to signal all children to exit
+                # Our fds are non-inheritable anyway, and not closing them lets
+                # subprocess use posix_spawn rather than fork/exec of our (large)
+                # process.
+                close_fds=False,
+                # Skip running with `podman exec` we are creating that ability here.
+                skip_pre_cmd=True,
             )
-            assert not timeout.is_expired()
 
-        self.logger.info("%s: started container", self.name)
+            self.logger.debug("%s: async_popen => %s", self, self.cmd_p.pid)
 
-        self.pytest_hook_open_shell()
+            self.pytest_hook_run_cmd(stdout, stderr)
 
-        return self.cmd_p
+            # ---------------------------------------
+            # Now let's wait until container shows up
+            # ---------------------------------------
+            started = False
+            if events_p is not None:
+                # Only wait a bit, the events backend may never deliver the event
+                started = await self._async_wait_start_event(
+                    events_p, min(_START_EVENT_WAIT, 30 - timeout.elapsed())
+                )
+            # Fallback to polling if the event wasn't seen (e.g., no events
+            # backend), backing off so a slow start doesn't cost a podman fork every
+            # 100ms.
+            delay = 0.05
+            while (
+                not started
+                and self.cmd_p.returncode is None
+                and not timeout.is_expired()
+            ):
+                o = await self.async_cmd_raises_host(
+                    f"podman ps -q -f name={self.container_id}"
+                )
+                if o.strip():
+                    break
+                elapsed = int(timeout.elapsed())
+                if elapsed > 3:
+                    self.logger.info("%s: run_cmd taking more than %ss", self, elapsed)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 1.0)
+            if self.cmd_p.returncode is not None:
+                self.logger.warning(
+                    "%s: run_cmd exited quickly (%ss) rc: %s",
+                    self,
+                    timeout.elapsed(),
+                    self.cmd_p.returncode,
+                )
+            elif timeout.is_expired():
+                self.logger.critical(
+                    "%s: timeout (%ss) waiting for container to start",
+                    self.name,
+                    timeout.elapsed(),
+                )
+                assert not timeout.is_expired()
+        finally:
+            # Don't leave the watcher behind if we failed or were cancelled
+            if events_p is not None and events_p.returncode is None:
+                events_p.terminate()
+                await events_p.wait()
+
+    async def _async_podman_start_events(self):
+        "Start `podman events` to report the start of our container, or None"
+        if not (podman := get_exec_path_host("podman")):
+            return None
+        try:
+            return await self.async_popen_host(
+                [
+                    podman,
+                    "events",
+                    "--format=json",
+                    f"--since={int(time_mod.time()) - 1}",
+                    f"--filter=container={self.container_id}",
+                    "--filter=event=start",
+                ],
+                stdin=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                # Run directly like `podman run` so terminating it ends the stream
+                skip_pre_cmd=True,
+            )
+        except OSError as error:
+            self.logger.debug("%s: can't watch podman events: %s", self, error)
+            return None
+
+    async def _async_wait_start_event(self, events_p, timeout):
+        """Wait for the container start event from `events_p`.
+
+        Returns True if the event was seen, or False if the events stream ended, the
+        container command exited or `timeout` expired first.
+        """
+        line_task = asyncio.ensure_future(events_p.stdout.readline())
+        exit_task = asyncio.ensure_future(self.cmd_p.wait())
+        try:
+            done, _ = await asyncio.wait(
+                (line_task, exit_task),
+                timeout=max(timeout, 0),
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            return line_task in done and bool(line_task.result().strip())
+        finally:
+            line_task.cancel()
+            exit_task.cancel()
+            if events_p.returncode is None:
+                events_p.terminate()
+            await events_p.wait()
 
     async def async_cleanup_cmd(self):
         """Run the configured cleanup commands for this node"""
@@ -1302,25 +1480,20 @@ class L3QemuVM(L3Node):
     async def run_cmd(self):
         """Run the configured commands for this node inside VM"""
 
-        self.logger.debug(
-            "[rundir %s exists %s]", self.rundir, os.path.exists(self.rundir)
-        )
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(
+                "[rundir %s exists %s]", self.rundir, os.path.exists(self.rundir)
+            )
 
-        shell_cmd = self.config.get("shell", "/bin/bash")
-        if not isinstance(shell_cmd, str):
-            if shell_cmd:
-                shell_cmd = "/bin/bash"
-            else:
-                shell_cmd = ""
+        shell_cmd = self.shell_cmd
 
         cmd = self.config.get("cmd", "").strip()
         if not cmd:
             return None
 
         # See if we have a custom update for this `kind`
-        if kind := self.config.get("kind", None):
-            if kind in kind_run_cmd_update:
-                await kind_run_cmd_update[kind](self, shell_cmd, [], cmd)
+        if update := kind_run_cmd_update.get(self.config.get("kind")):
+            await update(self, shell_cmd, [], cmd)
 
         if shell_cmd:
             cmd = cmd.rstrip()
@@ -1332,9 +1505,7 @@ class L3QemuVM(L3Node):
 
             # Write a copy to the rundir
             cmdpath = os.path.join(self.rundir, "cmd.shebang")
-            with open(cmdpath, mode="w+", encoding="utf-8") as cmdfile:
-                cmdfile.write(cmd)
-            self.cmd_raises_host(f"chmod 755 {cmdpath}")
+            write_exec_file(cmdpath, cmd)
 
             # Now write a copy inside the VM
             self.conrepl.cmd_status("cat > /tmp/cmd.shebang << EOF\n" + cmd + "\nEOF")
@@ -1778,6 +1949,9 @@ class Munet(BaseMunet):
 
         self.pytest_config = pytestconfig
 
+        # Limits concurrent container starts, created in `run()`
+        self.podman_sem = None
+
         # We need some way to actually get back to the root namespace
         if not self.isolated:
             self.rootcmd = commander
@@ -1936,9 +2110,15 @@ class Munet(BaseMunet):
         # Create connections
         # ------------------
 
+        hosts = self.hosts
+        switches = self.switches
+
         # Go through all connections and name them so they are sane to the user
-        # otherwise when we do p2p links the names/ords skip around based oddly
-        for name, node in self.hosts.items():
+        # otherwise when we do p2p links the names/ords skip around based oddly.
+        # Links are only recorded here, matching the peer's config requires all
+        # connections to have been normalized first.
+        pending_links = []
+        for name, node in hosts.items():
             nconf = node.config
             if "connections" not in nconf:
                 continue
@@ -1946,34 +2126,65 @@ class Munet(BaseMunet):
             for cconf in nconf["connections"]:
                 # Replace string only with a dictionary
                 if isinstance(cconf, str):
-                    splitconf = cconf.split(":", 1)
-                    cconf = {"to": splitconf[0]}
-                    if len(splitconf) == 2:
-                        cconf["name"] = splitconf[1]
+                    to, sep, ifname = cconf.partition(":")
+                    cconf = {"to": to}
+                    if sep:
+                        cconf["name"] = ifname
                 # Allocate a name if not already assigned
                 if "name" not in cconf:
                     cconf["name"] = node.get_next_intf_name()
                 nconns.append(cconf)
+                # Eventually can add support for unconnected intf here.
+                if "to" in cconf:
+                    pending_links.append((name, node, cconf))
             nconf["connections"] = nconns
 
-        for name, node in self.hosts.items():
-            nconf = node.config
-            if "connections" not in nconf:
-                continue
-            for cconf in nconf["connections"]:
-                # Eventually can add support for unconnected intf here.
-                if "to" not in cconf:
-                    continue
+        # Index each peer's connections by `to` once, rather than scanning them for
+        # every connection made to that peer.
+        conn_index = {}
+        match_config = find_matching_net_config
+        add_link = self._add_native_link
+
+        # Configure the links' addresses and constraints concurrently, each link runs
+        # a few ip/tc commands so bound how many are in flight at once.
+        sem = asyncio.Semaphore(_MAX_LINK_CONFIGS)
+
+        async def configure_link(coro):
+            async with sem:
+                await coro
+
+        configure_links = []
+        tasks = []
+        try:
+            for name, node, cconf in pending_links:
                 to = cconf["to"]
-                if to in self.switches:
-                    switch = self.switches[to]
-                    swconf = find_matching_net_config(name, cconf, switch.config)
-                    await self.add_native_link(switch, node, swconf, cconf)
+                if to in switches:
+                    switch = switches[to]
+                    swconf = switch.config
+                    if (index := conn_index.get(to)) is None:
+                        index = conn_index[to] = index_net_connections(swconf)
+                    swconf = match_config(name, cconf, swconf, index)
+                    configure_links.append(await add_link(switch, node, swconf, cconf))
                 elif cconf["name"] not in node.intfs:
                     # Only add the p2p interface if not already there.
-                    other = self.hosts[to]
-                    oconf = find_matching_net_config(name, cconf, other.config)
-                    await self.add_native_link(node, other, cconf, oconf)
+                    other = hosts[to]
+                    oconf = other.config
+                    if (index := conn_index.get(to)) is None:
+                        index = conn_index[to] = index_net_connections(oconf)
+                    oconf = match_config(name, cconf, oconf, index)
+                    configure_links.append(await add_link(node, other, cconf, oconf))
+
+            tasks = [asyncio.create_task(configure_link(x)) for x in configure_links]
+            await asyncio.gather(*tasks)
+        except BaseException:
+            # Don't leave the other links configuring after a failure
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # Close the configurations that never ran so they aren't left un-awaited
+            for coro in configure_links:
+                coro.close()
+            raise
 
     @property
     def autonumber(self):
@@ -1985,6 +2196,16 @@ class Munet(BaseMunet):
 
     async def add_native_link(self, node1, node2, c1=None, c2=None):
         """Add a link between switch and node or 2 nodes."""
+        await (await self._add_native_link(node1, node2, c1, c2))
+
+    async def _add_native_link(self, node1, node2, c1=None, c2=None):
+        """Add a link between switch and node or 2 nodes.
+
+        The link is created and its addresses assigned, and a coroutine is returned
+        that runs the commands to configure the link's addresses and constraints.
+        The configuration of different links is independent so may be run
+        concurrently.
+        """
         isp2p = False
 
         c1 = {} if c1 is None else c1
@@ -2033,15 +2254,25 @@ class Munet(BaseMunet):
                 mtu = c2.get("mtu")
             super().add_link(node1, node2, if1, if2, mtu=mtu)
 
+        # Addresses are allocated now so that numbering doesn't depend on the order
+        # links are configured in.
         if isp2p:
-            node1.set_p2p_addr(node2, c1, c2)
+            addr_cmds = node1.get_p2p_addr_cmds(node2, c1, c2)
         else:
-            node2.set_lan_addr(node1, c2)
+            addr_cmds = node2.get_lan_addr_cmds(node1, c2)
+
+        async def configure_link():
+            for node, ifname, cmd in addr_cmds:
+                if ifname:
+                    await node.async_intf_ip_cmd(ifname, cmd)
+                else:
+                    await node.async_cmd_raises(cmd)
+            if "physical" not in c1 and not node1.is_vm:
+                await node1.async_set_intf_constraints(if1, **c1)
+            if "physical" not in c2 and not node2.is_vm:
+                await node2.async_set_intf_constraints(if2, **c2)
 
-        if "physical" not in c1 and not node1.is_vm:
-            node1.set_intf_constraints(if1, **c1)
-        if "physical" not in c2 and not node2.is_vm:
-            node2.set_intf_constraints(if2, **c2)
+        return configure_link()
 
     def add_l3_node(self, name, config=None, **kwargs):
         """Add a node to munet."""
@@ -2063,6 +2294,31 @@ class Munet(BaseMunet):
         mtu = kwargs.get("mtu", config.get("mtu"))
         return super().add_switch(name, cls=cls, config=config, mtu=mtu, **kwargs)
 
+    async def prepull_images(self, nodes):
+        """Pull the container images used by `nodes` that aren't already present.
+
+        Each image is pulled once up front, rather than by every `podman run` that
+        uses it, with those pulls serialized on podman's lock.
+        """
+        images = {x.container_image for x in nodes if x.is_container}
+        # Use the same podman that `run_cmd` will
+        if not images or not (podman := get_exec_path_host("podman")):
+            return
+
+        async def prepull(image):
+            rc, _, _ = await self.rootcmd.async_cmd_status(
+                [podman, "image", "exists", image], warn=False
+            )
+            if not rc:
+                return
+            rc, _, e = await self.rootcmd.async_cmd_status(
+                [podman, "pull", "-q", image], warn=False
+            )
+            if rc:
+                self.logger.warning("%s: failed to pull %s: %s", self, image, e.strip())
+
+        await asyncio.gather(*[prepull(x) for x in sorted(images)])
+
     async def run(self):
         tasks = []
 
@@ -2105,7 +2361,10 @@ class Munet(BaseMunet):
             task.add_done_callback(node.launch_completed)
             tasks.append(task)
 
-        # the run
+        # the run, starting containers concurrently but not so many that they are just
+        # contending on podman's locks.
+        await self.prepull_images(run_nodes)
+        self.podman_sem = asyncio.Semaphore(os.cpu_count() or 4)
         await asyncio.gather(*[x.run_cmd() for x in run_nodes])
         for node in run_nodes:
             task = asyncio.create_task(node.cmd_p.wait(), name=f"Node-{node.name}-cmd")
@@ -2139,53 +2398,64 @@ class Munet(BaseMunet):
         await super()._async_delete()
 
 
+# Arista's OUI, used for generated ceos system MACs
+_ARISTA_OUI = "00:1c:73"
+
+
 async def run_cmd_update_ceos(node, shell_cmd, cmds, cmd):
     cmd = cmd.strip()
     if shell_cmd or cmd != "/sbin/init":
         return cmds, cmd
 
+    config = node.config
+    logger = node.logger
+
     #
     # Add flash dir and mount it
     #
     flashdir = os.path.join(node.rundir, "flash")
-    node.cmd_raises_host(f"mkdir -p {flashdir} && chmod 775 {flashdir}")
-    cmds += [f"--volume={flashdir}:/mnt/flash"]
+    startup_dest = f"{flashdir}/startup-config"
+    mac_dest = f"{flashdir}/system_mac_address"
+    os.makedirs(flashdir, mode=0o775, exist_ok=True)
+    # The makedirs mode is subject to the umask, so set it explicitly
+    os.chmod(flashdir, 0o775)
+    cmds.append(f"--volume={flashdir}:/mnt/flash")
+    with os.scandir(flashdir) as it:
+        existing = {e.name for e in it}
 
     #
     # Startup config (if not present already)
     #
-    if startup_config := node.config.get("startup-config", None):
-        dest = os.path.join(flashdir, "startup-config")
-        if os.path.exists(dest):
-            node.logger.info("Skipping copy of startup-config, already present")
+    if startup_config := config.get("startup-config", None):
+        if "startup-config" in existing:
+            logger.info("Skipping copy of startup-config, already present")
         else:
             source = os.path.join(node.unet.config_dirname, startup_config)
-            node.cmd_raises_host(f"cp {source} {dest} && chmod 664 {dest}")
+            copy_file(source, startup_dest, 0o664)
 
     #
     # system mac address (if not present already
     #
-    dest = os.path.join(flashdir, "system_mac_address")
-    if os.path.exists(dest):
-        node.logger.info("Skipping system-mac generation, already present")
+    if "system_mac_address" in existing:
+        logger.info("Skipping system-mac generation, already present")
     else:
-        random_arista_mac = "00:1c:73:%02x:%02x:%02x" % (
-            random.randint(0, 255),
-            random.randint(0, 255),
-            random.randint(0, 255),
-        )
-        system_mac = node.config.get("system-mac", random_arista_mac)
-        with open(dest, "w", encoding="ascii") as f:
-            f.write(system_mac + "\n")
-        node.cmd_raises_host(f"chmod 664 {dest}")
+        random_arista_mac = f"{_ARISTA_OUI}:{os.urandom(3).hex(':')}"
+        system_mac = config.get("system-mac", random_arista_mac)
+        # Write the raw bytes with the mode set on the fd, no text layer or chmod
+        fd = os.open(mac_dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o664)
+        try:
+            os.fchmod(fd, 0o664)
+            os.write(fd, system_mac.encode("ascii") + b"\n")
+        finally:
+            os.close(fd)
 
-    args = []
+    argv = [cmd]
 
     # Pass special args for the environment variables
-    if "env" in node.config:
-        args += [f"systemd.setenv={k}={v}" for k, v in node.config["env"].items()]
+    if env := config.get("env"):
+        argv.extend(f"systemd.setenv={k}={v}" for k, v in env.items())
 
-    return cmds, [cmd] + args
+    return cmds, argv
 
 
-kind_run_cmd_update = {"ceos": run_cmd_update_ceos}
+kind_run_cmd_update = MappingProxyType({"ceos": run_cmd_update_ceos})
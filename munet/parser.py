@@ -20,12 +20,16 @@
 #
 "A module that implements the standalone parser."
 import asyncio
+import concurrent.futures
+import copy
+import functools
+import hashlib
 import importlib.resources
 import json
 import logging
 import logging.config
 import os
-import subprocess
+import stat
 import sys
 import tempfile
 
@@ -38,10 +42,20 @@ from .config import config_to_dict_with_key
 from .native import Munet
 
 
+@functools.lru_cache(maxsize=None)
+def _get_data_dir():
+    "Return the directory holding munet's data files (schema, logconf, kinds)"
+    try:
+        return str(importlib.resources.files("munet"))
+    except AttributeError:
+        # python < 3.9
+        with importlib.resources.path("munet", "logconf.yaml") as datapath:
+            return str(datapath.parent)
+
+
 def get_schema():
     if get_schema.schema is None:
-        with importlib.resources.path("munet", "munet-schema.json") as datapath:
-            search = [str(datapath.parent)]
+        search = [_get_data_dir()]
         get_schema.schema = get_config(basename="munet-schema", search=search)
     return get_schema.schema
 
@@ -49,8 +63,7 @@ def get_schema():
 get_schema.schema = None
 
 
-def get_config(pathname=None, basename="munet", search=None, logf=logging.debug):
-
+def _resolve_path(pathname, basename, search, logf):
     if not search:
         search = [os.getcwd()]
     elif isinstance(search, str):
@@ -59,9 +72,15 @@ def get_config(pathname=None, basename="munet", search=None, logf=logging.debug)
     if not pathname:
         for d in search:
             logf("%s", f'searching in "{d}" for "{basename}".{{yaml, toml, json}}')
+            # One directory read instead of a stat per candidate extension
+            try:
+                with os.scandir(d) as it:
+                    names = {e.name for e in it if e.is_file()}
+            except OSError:
+                continue
             for ext in ("yaml", "toml", "json"):
-                pathname = os.path.join(d, basename + "." + ext)
-                if os.path.exists(pathname):
+                if basename + "." + ext in names:
+                    pathname = os.path.join(d, basename + "." + ext)
                     logf("%s", f'Found "{pathname}"')
                     break
             else:
@@ -84,67 +103,199 @@ def get_config(pathname=None, basename="munet", search=None, logf=logging.debug)
                 continue
             else:
                 raise FileNotFoundError(pathname + " in " + f"{search}")
+    return pathname
 
-    _, ext = pathname.rsplit(".", 1)
 
+def _make_loader(ext):
+    "Import the parser for `ext` and return a function to load file data with it"
     if ext == "json":
-        config = json.load(open(pathname, encoding="utf-8"))
+        try:
+            import orjson  # pylint: disable=C0415
+
+            load = orjson.loads  # pylint: disable=E1101
+        except ImportError:
+            load = json.loads
     elif ext == "toml":
-        import toml  # pylint: disable=C0415
+        try:
+            import tomllib  # pylint: disable=C0415
+        except ImportError:
+            import toml as tomllib  # pylint: disable=C0415
+
+        def load(data):
+            return tomllib.loads(data.decode("utf-8"))
 
-        config = toml.load(pathname)
     elif ext == "yaml":
         import yaml  # pylint: disable=C0415
 
-        config = yaml.safe_load(open(pathname, encoding="utf-8"))
+        # Use the libyaml based loader when available, it's much faster.
+        loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+        def load(data):
+            return yaml.load(data, Loader=loader)  # nosec
+
     else:
         raise ValueError("Filename does not end with (.json|.toml|.yaml)")
+    return load
+
 
-    config["config_pathname"] = os.path.realpath(pathname)
+_LOADERS = {}
+
+
+def _loader(ext):
+    if ext not in _LOADERS:
+        _LOADERS[ext] = _make_loader(ext)
+    return _LOADERS[ext]
+
+
+@functools.lru_cache(maxsize=32)
+def _parse_cached(pathname, ext, mtime_ns, size):
+    """Parse the config file at `pathname`.
+
+    `mtime_ns` and `size` are used to key the cache so that a modified file is
+    re-parsed. The returned object is shared, callers must copy it before modifying.
+
+    If the environment variable MUNET_CONFIG_CACHE names a directory, YAML and TOML
+    parse results are also cached there as JSON, which is much faster to load.
+    """
+    cachefile = None
+    if ext != "json" and (cachedir := os.environ.get("MUNET_CONFIG_CACHE")):
+        name = hashlib.sha256(pathname.encode("utf-8")).hexdigest() + ".json"
+        cachefile = os.path.join(cachedir, name)
+        config = _read_config_cache(cachefile, mtime_ns, size)
+        if config is not None:
+            return config
+
+    load = _loader(ext)
+    with open(pathname, "rb") as f:
+        config = load(f.read())
+
+    if cachefile:
+        _write_config_cache(cachefile, mtime_ns, size, config)
     return config
 
 
-def setup_logging(args):
-    # Create rundir and arrange for future commands to run in it.
+def _is_private(st):
+    "Return True if the file with stat `st` is ours and only writable by us"
+    return st.st_uid == os.geteuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
 
-    # Change CWD to the rundir prior to parsing config
-    old = os.getcwd()
-    os.chdir(args.rundir)
+
+def _read_config_cache(cachefile, mtime_ns, size):
+    """Return the config cached in `cachefile` if it is for the given file stat.
+
+    Configs hold commands we run (often as root), so the cache is ignored unless both
+    it and its directory are ours and only writable by us.
+    """
     try:
-        search = [old]
-        with importlib.resources.path("munet", "logconf.yaml") as datapath:
-            search.append(str(datapath.parent))
+        if not _is_private(os.stat(os.path.dirname(cachefile))):
+            logging.warning("Ignoring config cache in writable %s", cachefile)
+            return None
+        with open(cachefile, "rb") as f:
+            if not _is_private(os.fstat(f.fileno())):
+                logging.warning("Ignoring writable config cache %s", cachefile)
+                return None
+            cached = _loader("json")(f.read())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(cached, dict) or cached.get("key") != [mtime_ns, size]:
+        return None
+    return cached.get("config")
+
+
+def _write_config_cache(cachefile, mtime_ns, size, config):
+    "Cache `config` in `cachefile` if it survives a round trip through JSON"
+    try:
+        data = json.dumps({"key": [mtime_ns, size], "config": config})
+        if json.loads(data)["config"] != config:
+            return
+    except (TypeError, ValueError):
+        return
+    try:
+        cachedir = os.path.dirname(cachefile)
+        os.makedirs(cachedir, mode=0o700, exist_ok=True)
+        # Write to a temp file and rename so concurrent readers never see a partial
+        fd, tmpname = tempfile.mkstemp(dir=cachedir, suffix=".tmp")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            f.write(data)
+        os.replace(tmpname, cachefile)
+    except OSError as error:
+        logging.debug("Not caching config in %s: %s", cachefile, error)
+
+
+def get_config(pathname=None, basename="munet", search=None, logf=logging.debug):
+    pathname = _resolve_path(pathname, basename, search, logf)
+    realpath = os.path.realpath(pathname)
+
+    _, ext = pathname.rsplit(".", 1)
+    st = os.stat(realpath)
+    config = copy.deepcopy(_parse_cached(realpath, ext, st.st_mtime_ns, st.st_size))
+    config["config_pathname"] = realpath
+    return config
+
 
-        def logf(msg, *p, **k):
-            if args.verbose:
-                print("PRELOG: " + msg % p, **k, file=sys.stderr)
+def setup_logging(args):
+    # Create rundir and arrange for future commands to run in it.
 
-        config = get_config(args.log_config, "logconf", search, logf=logf)
-        pathname = config["config_pathname"]
-        del config["config_pathname"]
+    # Resolve relative paths against the rundir rather than changing the CWD
+    search = [os.getcwd()]
+    search.append(_get_data_dir())
 
+    def logf(msg, *p, **k):
         if args.verbose:
-            config["handlers"]["console"]["level"] = "DEBUG"
-        logging.config.dictConfig(dict(config))
-        logging.info("Loaded logging config %s", pathname)
-    finally:
-        os.chdir(old)
+            print("PRELOG: " + msg % p, **k, file=sys.stderr)
+
+    log_config = args.log_config
+    if log_config and not os.path.isabs(log_config):
+        if os.path.exists(os.path.join(args.rundir, log_config)):
+            log_config = os.path.join(args.rundir, log_config)
+
+    config = get_config(log_config, "logconf", search, logf=logf)
+    pathname = config["config_pathname"]
+    del config["config_pathname"]
+
+    # Reject a malformed config up front rather than failing part way through
+    handlers = config.get("handlers", {})
+    if "version" not in config or not isinstance(handlers, dict):
+        raise ValueError(f"{pathname}: not a valid logging config")
+    if not all(isinstance(h, dict) for h in handlers.values()):
+        raise ValueError(f"{pathname}: logging handlers must be mappings")
+
+    # Log files with relative names are created in the rundir
+    for handler in handlers.values():
+        if "filename" in handler and not os.path.isabs(handler["filename"]):
+            handler["filename"] = os.path.join(args.rundir, handler["filename"])
+
+    if args.verbose and "console" in handlers:
+        handlers["console"]["level"] = "DEBUG"
+    logging.config.dictConfig(dict(config))
+    logging.info("Loaded logging config %s", pathname)
 
 
 def append_hosts_files(unet, netname):
     if not netname:
         return
 
-    entries = []
-    for name, node in unet.hosts.items():
-        ifname = node.get_ifname(netname)
-        if ifname in node.intf_addrs:
-            entries.append((name, node.intf_addrs[ifname].ip))
-    for name, node in unet.hosts.items():
-        with open(os.path.join(node.rundir, "hosts.txt"), "w+", encoding="ascii") as hf:
-            hf.write("\n")
-            for e in entries:
-                hf.write(f"{e[1]}\t{e[0]}\n")
+    # The interface is registered against the network when the link is added
+    entries = [
+        (name, addr.ip)
+        for name, node in unet.hosts.items()
+        if (ifname := node.net_intfs.get(netname) or node.get_ifname(netname))
+        and (addr := node.intf_addrs.get(ifname)) is not None
+    ]
+    # Format the entries once and write them to each host with a single write.
+    body = ("\n" + "".join(f"{e[1]}\t{e[0]}\n" for e in entries)).encode("ascii")
+
+    def write_hosts(node):
+        with open(os.path.join(node.rundir, "hosts.txt"), "ab") as hf:
+            hf.write(body)
+
+    # The writes are independent so overlap them, this matters on slow filesystems
+    hosts = list(unet.hosts.values())
+    if not hosts:
+        return
+    with concurrent.futures.ThreadPoolExecutor(min(32, len(hosts))) as executor:
+        # Consume the results so that any error is raised here.
+        for _ in executor.map(write_hosts, hosts):
+            pass
 
 
 def validate_config(config, logger, args):
@@ -177,8 +328,7 @@ def load_kinds(args):
     args_config = args.kinds_config if args else None
     try:
         search = [old]
-        with importlib.resources.path("munet", "kinds.yaml") as datapath:
-            search.append(str(datapath.parent))
+        search.append(_get_data_dir())
 
         config = get_config(args_config, "kinds", search)
 
@@ -205,7 +355,8 @@ async def async_build_topology(
 ):
     if not rundir:
         rundir = tempfile.mkdtemp(prefix="unet")
-    subprocess.run(f"mkdir -p {rundir} && chmod 755 {rundir}", check=True, shell=True)
+    os.makedirs(rundir, exist_ok=True)
+    os.chmod(rundir, 0o755)
 
     isolated = not args.host if args else True
     if not config:
@@ -46,6 +46,11 @@ def _load_libc():
     libc = ctypes.CDLL(lcpath, use_errno=True)
 
 
+def load_libc():
+    """Load libc now, e.g., before forking a child that calls into it."""
+    _load_libc()
+
+
 def pidfd_open(pid, flags=0):
     if sys.version_info[0] > 3 or (
         sys.version_info[0] == 3 and sys.version_info[1] > 8
@@ -80,6 +85,17 @@ def unshare(flags):
         raise_oserror(ctypes.get_errno())
 
 
+def set_pdeathsig(signum):
+    """see PR_SET_PDEATHSIG in prctl(2)"""
+    if not libc:
+        _load_libc()
+
+    if libc.prctl(PR_SET_PDEATHSIG, int(signum), 0, 0, 0) == -1:
+        raise_oserror(ctypes.get_errno())
+
+
+PR_SET_PDEATHSIG = 1
+
 CLONE_NEWTIME = 0x00000080
 CLONE_VM = 0x00000100
 CLONE_FS = 0x00000200
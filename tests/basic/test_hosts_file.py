@@ -0,0 +1,68 @@
+# -*- coding: utf-8 eval: (blacken-mode 1) -*-
+#
+# Copyright 2023, LabN Consulting, L.L.C.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; see the file COPYING; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+#
+"Testing the nodes' hosts files."
+import ipaddress
+
+from types import SimpleNamespace
+
+from munet.parser import append_hosts_files
+
+
+_HEADER = b"::1\tip6-localhost ip6-loopback\n"
+
+
+def _node(tmp_path, name, ifname, ip):
+    rundir = tmp_path / name
+    rundir.mkdir()
+    # As created by the node when it is constructed
+    (rundir / "hosts.txt").write_bytes(
+        f"127.0.0.1\tlocalhost {name}\n".encode("ascii") + _HEADER
+    )
+    net_intfs = {"net0": ifname} if ifname else {}
+    return SimpleNamespace(
+        rundir=str(rundir),
+        net_intfs=net_intfs,
+        intf_addrs={ifname: ipaddress.ip_interface(ip)} if ifname else {},
+        get_ifname=net_intfs.get,
+    )
+
+
+def test_append_hosts_files(tmp_path):
+    hosts = {
+        "r1": _node(tmp_path, "r1", "eth0", "10.0.1.1/24"),
+        "r2": _node(tmp_path, "r2", "eth1", "10.0.1.2/24"),
+        # Not on the DNS network
+        "r3": _node(tmp_path, "r3", None, None),
+    }
+    append_hosts_files(SimpleNamespace(hosts=hosts), "net0")
+
+    for name in hosts:
+        expected = (
+            f"127.0.0.1\tlocalhost {name}\n".encode("ascii")
+            + _HEADER
+            + b"\n10.0.1.1\tr1\n10.0.1.2\tr2\n"
+        )
+        assert (tmp_path / name / "hosts.txt").read_bytes() == expected
+
+
+def test_append_hosts_files_no_network(tmp_path):
+    hosts = {"r1": _node(tmp_path, "r1", "eth0", "10.0.1.1/24")}
+    before = (tmp_path / "r1" / "hosts.txt").read_bytes()
+    append_hosts_files(SimpleNamespace(hosts=hosts), None)
+    assert (tmp_path / "r1" / "hosts.txt").read_bytes() == before
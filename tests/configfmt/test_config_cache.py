@@ -0,0 +1,136 @@
+# -*- coding: utf-8 eval: (blacken-mode 1) -*-
+#
+# Copyright 2023, LabN Consulting, L.L.C.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; see the file COPYING; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+#
+"Testing config file parse caching."
+import json
+import os
+
+import pytest
+
+from munet import parser
+
+
+@pytest.fixture(name="cachedir")
+def fixture_cachedir(tmp_path, monkeypatch):
+    cachedir = tmp_path / "cache"
+    monkeypatch.setenv("MUNET_CONFIG_CACHE", str(cachedir))
+    # Start and finish with an empty in-memory cache
+    parser._parse_cached.cache_clear()  # pylint: disable=W0212
+    yield cachedir
+    parser._parse_cached.cache_clear()  # pylint: disable=W0212
+
+
+def _write(path, text, mtime_ns):
+    path.write_text(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def _no_yaml(monkeypatch):
+    "Make parsing YAML fail so a config can only come from the cache"
+
+    def load(data):
+        raise AssertionError("YAML parsed rather than using the cache")
+
+    monkeypatch.setitem(parser._LOADERS, "yaml", load)  # pylint: disable=W0212
+    parser._parse_cached.cache_clear()  # pylint: disable=W0212
+
+
+def test_cache_hit(tmp_path, cachedir, monkeypatch):
+    path = tmp_path / "test.yaml"
+    _write(path, "topology:\n  nodes:\n    - name: r1\n", 10**18)
+
+    config = parser.get_config(str(path))
+    assert config["topology"] == {"nodes": [{"name": "r1"}]}
+    assert len(os.listdir(cachedir)) == 1
+
+    _no_yaml(monkeypatch)
+    assert parser.get_config(str(path)) == config
+
+
+def test_cache_invalidated(tmp_path, cachedir, monkeypatch):
+    path = tmp_path / "test.yaml"
+    _write(path, "value: 1\n", 10**18)
+    assert parser.get_config(str(path))["value"] == 1
+
+    # Same size but a new mtime
+    _write(path, "value: 2\n", 2 * 10**18)
+    parser._parse_cached.cache_clear()  # pylint: disable=W0212
+    assert parser.get_config(str(path))["value"] == 2
+
+    # New size with the same mtime
+    _write(path, "value: 300\n", 2 * 10**18)
+    parser._parse_cached.cache_clear()  # pylint: disable=W0212
+    assert parser.get_config(str(path))["value"] == 300
+
+    # The cache now holds the latest parse
+    _no_yaml(monkeypatch)
+    assert parser.get_config(str(path))["value"] == 300
+    assert len(os.listdir(cachedir)) == 1
+
+
+@pytest.mark.parametrize(
+    "text", ["date: 2023-01-01\n", "values:\n  1: one\n"], ids=["date", "intkey"]
+)
+def test_cache_not_json(tmp_path, cachedir, text):
+    path = tmp_path / "test.yaml"
+    _write(path, text, 10**18)
+
+    config = parser.get_config(str(path))
+    assert not os.path.exists(cachedir) or not os.listdir(cachedir)
+
+    # Still parsed from the YAML (with its non-JSON values) next time
+    parser._parse_cached.cache_clear()  # pylint: disable=W0212
+    assert parser.get_config(str(path)) == config
+
+
+@pytest.mark.usefixtures("cachedir")
+def test_config_copies(tmp_path):
+    path = tmp_path / "test.yaml"
+    _write(path, "topology:\n  nodes:\n    - name: r1\n", 10**18)
+
+    config = parser.get_config(str(path))
+    config["topology"]["nodes"][0]["name"] = "changed"
+    config["topology"]["nodes"].append({"name": "r2"})
+
+    assert parser.get_config(str(path))["topology"] == {"nodes": [{"name": "r1"}]}
+
+
+@pytest.mark.parametrize("untrusted", ["file-mode", "dir-mode", "owner"])
+def test_cache_untrusted(tmp_path, cachedir, untrusted):
+    path = tmp_path / "test.yaml"
+    _write(path, "cmd: 'true'\n", 10**18)
+    assert parser.get_config(str(path))["cmd"] == "true"
+
+    # Another user slips a command into the cache, and it'd be used if trusted
+    (cachefile,) = cachedir.iterdir()
+    cached = json.loads(cachefile.read_text())
+    cached["config"]["cmd"] = "injected"
+    cachefile.write_text(json.dumps(cached))
+    parser._parse_cached.cache_clear()  # pylint: disable=W0212
+    assert parser.get_config(str(path))["cmd"] == "injected"
+
+    if untrusted == "file-mode":
+        cachefile.chmod(0o666)
+    elif untrusted == "dir-mode":
+        cachedir.chmod(0o777)
+    elif os.geteuid() == 0:
+        os.chown(cachefile, 65534, -1)
+    else:
+        pytest.skip("changing the owner requires root")
+    parser._parse_cached.cache_clear()  # pylint: disable=W0212
+    assert parser.get_config(str(path))["cmd"] == "true"
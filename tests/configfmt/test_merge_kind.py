@@ -0,0 +1,82 @@
+# -*- coding: utf-8 eval: (blacken-mode 1) -*-
+#
+# Copyright 2023, LabN Consulting, L.L.C.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; see the file COPYING; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+#
+"Testing merging of kind configs into node configs."
+from copy import deepcopy
+
+from munet.config import config_to_dict_with_key
+from munet.config import merge_kind_config
+from munet.parser import load_kinds
+
+
+def test_merge_kind_values():
+    kconf = {
+        "name": "k",
+        "merge": ["volumes", "env", "opts"],
+        "volumes": ["/a:/a"],
+        "env": {"A": "1", "B": "2"},
+        "opts": "kind",
+        "cmd": "kind-cmd",
+        "image": "kind-image",
+    }
+    config = {
+        "volumes": ("/b:/b",),
+        "env": {"B": "3", "C": "4"},
+        "opts": "node",
+        "cmd": "node-cmd",
+        "shell": False,
+    }
+    new = merge_kind_config(kconf, config)
+
+    # Merged lists extend with any iterable
+    assert new["volumes"] == ["/a:/a", "/b:/b"]
+    # Merged dicts have the node values overriding the kind values
+    assert new["env"] == {"A": "1", "B": "3", "C": "4"}
+    # Merged scalars and unmerged values are replaced
+    assert new["opts"] == "node"
+    assert new["cmd"] == "node-cmd"
+    # Values only in one or the other are kept
+    assert new["image"] == "kind-image"
+    assert new["shell"] is False
+
+
+def test_merge_kind_no_mutation():
+    kconf = {"merge": ["volumes", "env"], "volumes": ["/a:/a"], "env": {"A": "1"}}
+    config = {"volumes": ["/b:/b"], "env": {"B": "2"}, "cmd": "true"}
+    okconf = deepcopy(kconf)
+    oconfig = deepcopy(config)
+
+    new = merge_kind_config(kconf, config)
+    new["volumes"].append("/c:/c")
+    new["env"]["C"] = "3"
+
+    assert kconf == okconf
+    assert config == oconfig
+
+
+def test_merge_bundled_ceos_kind():
+    kinds = load_kinds(None)
+    kconf = deepcopy(kinds["ceos"])
+    config = {"name": "r1", "kind": "ceos", "env": [{"name": "X", "value": "1"}]}
+    config_to_dict_with_key(config, "env", "name")
+
+    new = merge_kind_config(kinds["ceos"], config)
+
+    assert len(new["env"]) == len(kconf["env"]) + 1
+    assert new["env"][: len(kconf["env"])] == kconf["env"]
+    assert kinds["ceos"] == kconf
@@ -0,0 +1,97 @@
+# -*- coding: utf-8 eval: (blacken-mode 1) -*-
+#
+# Copyright 2023, LabN Consulting, L.L.C.
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; see the file COPYING; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
+#
+"Testing the ceos kind run command update."
+import logging
+import os
+
+from types import SimpleNamespace
+
+import pytest
+
+from munet.config import config_to_dict_with_key
+from munet.native import run_cmd_update_ceos
+
+
+# All tests are coroutines
+pytestmark = pytest.mark.asyncio
+
+
+def _ceos_node(tmp_path, config):
+    rundir = tmp_path / "r1"
+    rundir.mkdir()
+    (tmp_path / "startup.cfg").write_text("hostname r1\n")
+    return SimpleNamespace(
+        rundir=str(rundir),
+        config=config,
+        logger=logging.getLogger("r1"),
+        unet=SimpleNamespace(config_dirname=str(tmp_path)),
+    )
+
+
+async def test_ceos_update(tmp_path):
+    config = {
+        "startup-config": "startup.cfg",
+        "system-mac": "00:1c:73:aa:bb:cc",
+        "env": [{"name": "ETBA", "value": "4"}, {"name": "CEOS", "value": "1"}],
+    }
+    # The env is converted to a dict when the topology is built
+    config_to_dict_with_key(config, "env", "name")
+    node = _ceos_node(tmp_path, config)
+
+    cmds, argv = await run_cmd_update_ceos(node, "", ["podman"], "/sbin/init")
+
+    flashdir = os.path.join(node.rundir, "flash")
+    assert cmds == ["podman", f"--volume={flashdir}:/mnt/flash"]
+    assert argv[0] == "/sbin/init"
+    assert len(argv) == 3
+    assert argv[1].startswith("systemd.setenv=ETBA=")
+    assert argv[2].startswith("systemd.setenv=CEOS=")
+
+    with open(os.path.join(flashdir, "startup-config"), encoding="ascii") as f:
+        assert f.read() == "hostname r1\n"
+    with open(os.path.join(flashdir, "system_mac_address"), encoding="ascii") as f:
+        assert f.read() == "00:1c:73:aa:bb:cc\n"
+    for name in ("startup-config", "system_mac_address"):
+        assert os.stat(os.path.join(flashdir, name)).st_mode & 0o777 == 0o664
+
+
+async def test_ceos_update_existing(tmp_path):
+    node = _ceos_node(tmp_path, {"startup-config": "startup.cfg"})
+    flashdir = os.path.join(node.rundir, "flash")
+    os.mkdir(flashdir)
+    for name in ("startup-config", "system_mac_address"):
+        with open(os.path.join(flashdir, name), "w", encoding="ascii") as f:
+            f.write("existing\n")
+
+    _, argv = await run_cmd_update_ceos(node, "", [], "/sbin/init")
+
+    assert argv == ["/sbin/init"]
+    for name in ("startup-config", "system_mac_address"):
+        with open(os.path.join(flashdir, name), encoding="ascii") as f:
+            assert f.read() == "existing\n"
+
+
+async def test_ceos_update_not_init(tmp_path):
+    node = _ceos_node(tmp_path, {})
+    assert await run_cmd_update_ceos(node, "/bin/bash", [], "/sbin/init") == (
+        [],
+        "/sbin/init",
+    )
+    assert await run_cmd_update_ceos(node, "", [], "/bin/foo") == ([], "/bin/foo")
+    assert not os.path.exists(os.path.join(node.rundir, "flash"))
@@ -19,20 +19,42 @@
 # Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA 02110-1301 USA
 #
 "Testing use of pexect/REPL in munet."
+import asyncio
 import logging
 import os
-import time
 
 import pytest
 
+from munet.base import Timeout
+
 
 # All tests are coroutines
 pytestmark = pytest.mark.asyncio
 
+# Expected entries of /sys (less "hypervisor" which is only present on some hosts)
+_EXPECTED_SYS = frozenset(
+    "block bus class dev devices firmware fs kernel module power".split()
+)
+
+# Only parametrize over the shells that are installed
+_AVAILABLE_SHELLS = [
+    x for x in ("/bin/bash", "/bin/dash", "/usr/bin/ksh") if os.path.exists(x)
+]
+
+
+async def _wait_ready(host, timeout=2.0):
+    "Wait until `host` can run commands, rather than sleeping a fixed time."
+    timeout = Timeout(timeout)
+    while not timeout.is_expired():
+        rc, _, _ = await host.async_cmd_status("true", warn=False)
+        if not rc:
+            return
+        await asyncio.sleep(0.02)
+
 
 async def _test_repl(unet, hostname, cmd, use_pty, will_echo=False):
     host = unet.hosts[hostname]
-    time.sleep(1)
+    await _wait_ready(host)
     repl = await host.console(
         cmd, user="root", use_pty=use_pty, will_echo=will_echo, trace=True
     )
@@ -41,12 +63,9 @@ async def _test_repl(unet, hostname, cmd, use_pty, will_echo=False):
 
 @pytest.mark.parametrize("host", ["r1", "r2"])
 @pytest.mark.parametrize("mode", ["pty", "piped"])
-@pytest.mark.parametrize("shellcmd", ["/bin/bash", "/bin/dash", "/usr/bin/ksh"])
-async def test_spawn(unet, host, mode, shellcmd):
-    if not os.path.exists(shellcmd):
-        pytest.skip(f"{shellcmd} not installed skipping")
-
-    os.environ["TEST_SHELL"] = shellcmd
+@pytest.mark.parametrize("shellcmd", _AVAILABLE_SHELLS)
+async def test_spawn(unet, host, mode, shellcmd, monkeypatch):
+    monkeypatch.setenv("TEST_SHELL", shellcmd)
     if mode == "pty":
         repl = await _test_repl(unet, host, [shellcmd], use_pty=True)
     else:
@@ -64,13 +83,9 @@ async def test_spawn(unet, host, mode, shellcmd):
         logging.debug("'env | grep TEST_SHELL' output: %s", output)
         assert output == f"TEST_SHELL={shellcmd}"
 
-        expected = (
-            "block\nbus\nclass\ndev\ndevices\nfirmware\nfs\nkernel\nmodule\npower"
-        )
         rc, output = repl.cmd_status("ls --color=never -1 /sys")
-        output = output.replace("hypervisor\n", "")
         logging.debug("'ls --color=never -1 /sys' rc: %s output: %s", rc, output)
-        assert output == expected
+        assert set(output.split()) - {"hypervisor"} == _EXPECTED_SYS
 
         if shellcmd == "/bin/bash":
             output = repl.cmd_raises("!!")